@@ -0,0 +1,125 @@
+"""Admission control: update priorities and a limit on concurrent RetailCRM calls"""
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from fast_update import get_callback_verb
+
+# Lower value is processed first
+PRIORITY_HIGH = 0  # delivery and return confirmations
+PRIORITY_NORMAL = 1  # order cards, authorization
+PRIORITY_LOW = 2  # menu, order lists, ratings
+
+CALLBACK_PRIORITIES = {
+    'ORDER_APPROVE': PRIORITY_HIGH,
+    'ORDER': PRIORITY_NORMAL,
+    'CALL_CUSTOMER': PRIORITY_NORMAL,
+}
+
+
+def classify_update(update):
+    """Get the priority of a raw update"""
+    callback_query = update.get('callback_query')
+    if callback_query is not None:
+        return CALLBACK_PRIORITIES.get(get_callback_verb(callback_query.get('data', '')), PRIORITY_LOW)
+
+    message = update.get('message')
+    if message is not None and ('contact' in message or message.get('text', '').startswith('/order ')):
+        return PRIORITY_NORMAL
+    return PRIORITY_LOW
+
+
+class CrmBusyError(Exception):
+    """No RetailCRM call slot became free in time"""
+
+
+class CrmLimiter:
+    """Proxy for the RetailCRM client that bounds concurrent calls and tracks their latency
+
+    Some of the slots are reserved for high priority calls, so slow order lists and prefetch
+    cannot take all of them from confirmations and the outbox. The priority of calls made by
+    a thread is set with the priority() context manager.
+    """
+
+    def __init__(self, client, max_concurrent, reserved=1, acquire_timeout=10, latency_window=60):
+        self._client = client
+        self._max_concurrent = max_concurrent
+        self._max_shared = max(1, max_concurrent - reserved)
+        self._acquire_timeout = acquire_timeout
+        self._condition = threading.Condition()
+        self._in_use = 0
+        self._local = threading.local()
+        # Start times of calls in progress, by call number
+        self._in_flight = {}
+        self._call_numbers = itertools.count()
+        # (finished_at, elapsed) of calls within the last latency_window seconds
+        self._samples = deque()
+        self._latency_window = latency_window
+
+    @property
+    def latency(self):
+        """Average call latency in seconds over the window, calls in progress count with their time so far
+
+        Returns 0 when there were no recent calls.
+        """
+        now = time.monotonic()
+        with self._condition:
+            self._expire(now)
+            elapsed = [elapsed for _, elapsed in self._samples]
+            elapsed.extend(now - started_at for started_at in self._in_flight.values())
+        if not elapsed:
+            return 0.0
+        return sum(elapsed) / len(elapsed)
+
+    @contextmanager
+    def priority(self, priority):
+        """Make calls of the current thread with the given priority"""
+        previous = getattr(self._local, 'priority', PRIORITY_LOW)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            number = self._acquire()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._release(number)
+
+        return call
+
+    def _acquire(self):
+        high = getattr(self._local, 'priority', PRIORITY_LOW) == PRIORITY_HIGH
+        limit = self._max_concurrent if high else self._max_shared
+        deadline = time.monotonic() + self._acquire_timeout
+        with self._condition:
+            while self._in_use >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CrmBusyError(f"No free RetailCRM slot in {self._acquire_timeout}s")
+                self._condition.wait(remaining)
+            self._in_use += 1
+            number = next(self._call_numbers)
+            self._in_flight[number] = time.monotonic()
+            return number
+
+    def _release(self, number):
+        now = time.monotonic()
+        with self._condition:
+            self._in_use -= 1
+            self._samples.append((now, now - self._in_flight.pop(number)))
+            self._expire(now)
+            self._condition.notify_all()
+
+    def _expire(self, now):
+        while self._samples and now - self._samples[0][0] > self._latency_window:
+            self._samples.popleft()
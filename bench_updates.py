@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Сравнение разбора обновлений Telegram: полный Update.de_json и быстрый путь fast_update.
+Показывает время и пиковый объём выделенной памяти на одно обновление callback_query.
+"""
+import json
+import time
+import tracemalloc
+
+import telebot
+
+from fast_update import decode_update, get_callback_verb, LazyCallbackQuery
+
+UPDATE = json.dumps({
+    'update_id': 100000001,
+    'callback_query': {
+        'id': '4382bfdwdsb323b2d9',
+        'from': {'id': 123456789, 'is_bot': False, 'first_name': 'Иван', 'username': 'courier', 'language_code': 'ru'},
+        'message': {
+            'message_id': 4521,
+            'from': {'id': 987654321, 'is_bot': True, 'first_name': 'Bot Kurier', 'username': 'bot_kurier_bot'},
+            'chat': {'id': 123456789, 'first_name': 'Иван', 'username': 'courier', 'type': 'private'},
+            'date': 1760000000,
+            'text': 'Собранные для вас заказы:',
+            'reply_markup': {'inline_keyboard': [
+                [{'text': f'{10000 + i}A (2025-10-19 10:00-12:00)', 'callback_data': f'ORDER;{50000 + i}'}]
+                for i in range(10)
+            ]},
+        },
+        'chat_instance': '-1234567890123456789',
+        'data': 'ORDER_APPROVE;50003;DELIVERY',
+    },
+}).encode('utf-8')
+
+ROUNDS = 10000
+
+
+def full_decode(body):
+    update = telebot.types.Update.de_json(body.decode('utf-8'))
+    call = update.callback_query
+    return call.data, call.message.chat.id, call.message.message_id
+
+
+def fast_decode(body):
+    update = decode_update(body)
+    call = LazyCallbackQuery(update['callback_query'])
+    get_callback_verb(call.data)
+    return call.data, call.message.chat.id, call.message.message_id
+
+
+def bench(name, decode):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        decode(UPDATE)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    # The first call under tracing fills caches, the peak is taken from the second one
+    decode(UPDATE)
+    tracemalloc.reset_peak()
+    decode(UPDATE)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"{name}: {elapsed / ROUNDS * 1e6:.1f} мкс на обновление, пик памяти {peak} байт")
+
+
+if __name__ == '__main__':
+    bench('Update.de_json', full_decode)
+    bench('fast_update', fast_decode)
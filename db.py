@@ -1,7 +1,10 @@
-import sqlite3
+import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import random
 
+from storage import get_backend
+
 
 MOTIVATIONAL_PHRASES = [
     "Отличная работа! Так держать! 🎉",
@@ -22,26 +25,32 @@ MOTIVATIONAL_PHRASES = [
 ]
 
 
-class DB:
-    def __init__(self):
-        self._db_path = 'db.sqlite3'
-        self._init_db()
+def _backfill_completed_order_ids(cursor):
+    """Record ids of orders already completed, including the archived ones"""
+    cursor.execute("SELECT table_name FROM completed_orders_archives")
+    tables = ['completed_orders'] + [table_name for table_name, in cursor.fetchall()]
+    for table_name in tables:
+        cursor.execute(
+            f"""
+            INSERT INTO completed_order_ids (order_id)
+            SELECT DISTINCT order_id FROM {table_name} WHERE order_id IS NOT NULL
+            ON CONFLICT (order_id) DO NOTHING
+            """
+        )
 
-    def _init_db(self):
-        """Initialize database tables"""
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
-        
-        # Table for courier chat_id to courier_id mapping
-        cursor.execute("""
+
+# Schema migrations, applied in order. A migration is a list of statements (or functions
+# taking a cursor), or a dict of statement lists per backend dialect where the SQL differs.
+MIGRATIONS = [
+    {
+        'sqlite': [
+            """
             CREATE TABLE IF NOT EXISTS courier (
-                chat_id INTEGER PRIMARY KEY, 
+                chat_id INTEGER PRIMARY KEY,
                 courier_id INTEGER
             )
-        """)
-        
-        # Table for completed orders
-        cursor.execute("""
+            """,
+            """
             CREATE TABLE IF NOT EXISTS completed_orders (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 courier_id INTEGER,
@@ -49,42 +58,402 @@ class DB:
                 order_number TEXT,
                 completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        """)
-        
-        db.commit()
-        db.close()
+            """,
+        ],
+        'postgres': [
+            """
+            CREATE TABLE IF NOT EXISTS courier (
+                chat_id BIGINT PRIMARY KEY,
+                courier_id INTEGER
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS completed_orders (
+                id SERIAL PRIMARY KEY,
+                courier_id INTEGER,
+                order_id TEXT,
+                order_number TEXT,
+                completed_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+            )
+            """,
+        ],
+    },
+    # One completed record per order, so repeated confirmations do not inflate ratings
+    [
+        """
+        DELETE FROM completed_orders
+        WHERE id NOT IN (SELECT MIN(id) FROM completed_orders GROUP BY order_id)
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_completed_orders_order_id ON completed_orders (order_id)",
+    ],
+    # Outbox of order status changes to be sent to RetailCRM
+    {
+        'sqlite': [
+            """
+            CREATE TABLE IF NOT EXISTS crm_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id TEXT,
+                site TEXT,
+                status TEXT,
+                created_at TIMESTAMP,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                last_error TEXT,
+                sent_at TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_crm_outbox_pending ON crm_outbox (sent_at, order_id)",
+        ],
+        'postgres': [
+            """
+            CREATE TABLE IF NOT EXISTS crm_outbox (
+                id SERIAL PRIMARY KEY,
+                order_id TEXT,
+                site TEXT,
+                status TEXT,
+                created_at TIMESTAMP,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                last_error TEXT,
+                sent_at TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_crm_outbox_pending ON crm_outbox (sent_at, order_id)",
+        ],
+    },
+    # Short-lived results of processed callbacks
+    [
+        """
+        CREATE TABLE IF NOT EXISTS idempotency (
+            key TEXT PRIMARY KEY,
+            result TEXT,
+            created_at TIMESTAMP
+        )
+        """,
+    ],
+    # Indexes for rating queries and registry of monthly archives of completed orders
+    [
+        "CREATE INDEX IF NOT EXISTS idx_completed_orders_completed_at ON completed_orders (completed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_completed_orders_courier ON completed_orders (courier_id, completed_at)",
+        """
+        CREATE TABLE IF NOT EXISTS completed_orders_archives (
+            month TEXT PRIMARY KEY,
+            table_name TEXT,
+            month_start TIMESTAMP,
+            month_end TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS completed_orders_monthly (
+            month TEXT,
+            courier_id INTEGER,
+            order_count INTEGER,
+            PRIMARY KEY (month, courier_id)
+        )
+        """,
+    ],
+    # Telegram updates: ids already accepted by any instance, and updates left by a stopped instance
+    {
+        'sqlite': [
+            "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at TIMESTAMP)",
+            "CREATE TABLE IF NOT EXISTS pending_updates (update_id INTEGER PRIMARY KEY, payload TEXT)",
+        ],
+        'postgres': [
+            "CREATE TABLE IF NOT EXISTS seen_updates (update_id BIGINT PRIMARY KEY, seen_at TIMESTAMP)",
+            "CREATE TABLE IF NOT EXISTS pending_updates (update_id BIGINT PRIMARY KEY, payload TEXT)",
+        ],
+    },
+    # Progress of daily summaries, one row per chat that got (or is getting) the summary
+    {
+        'sqlite': [
+            """
+            CREATE TABLE IF NOT EXISTS summary_runs (
+                run_date TEXT,
+                chat_id INTEGER,
+                sent_at TIMESTAMP,
+                PRIMARY KEY (run_date, chat_id)
+            )
+            """,
+        ],
+        'postgres': [
+            """
+            CREATE TABLE IF NOT EXISTS summary_runs (
+                run_date TEXT,
+                chat_id BIGINT,
+                sent_at TIMESTAMP,
+                PRIMARY KEY (run_date, chat_id)
+            )
+            """,
+        ],
+    },
+    # Ids of all completed orders, kept when the orders are archived
+    [
+        "CREATE TABLE IF NOT EXISTS completed_order_ids (order_id TEXT PRIMARY KEY)",
+        _backfill_completed_order_ids,
+    ],
+    # Status changes given up after too many failed attempts
+    [
+        "ALTER TABLE crm_outbox ADD COLUMN failed_at TIMESTAMP",
+    ],
+]
+
+# Lease for a claimed outbox entry, so other instances do not send it at the same time
+OUTBOX_CLAIM_SECONDS = 60
+
+
+def _parse_timestamp(value):
+    # SQLite returns timestamps as strings, PostgreSQL as datetime
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _month_start(date):
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month_start(date):
+    return (_month_start(date) + timedelta(days=32)).replace(day=1)
+
+
+def _period_start(date, period):
+    """Get the start of the day, week or month containing the date"""
+    if period == 'week':
+        date = date - timedelta(days=date.weekday())
+    elif period == 'month':
+        date = date.replace(day=1)
+    return date.date() if isinstance(date, datetime) else date
 
-    def get_courier_id(self, chat_id):
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
-        cursor.execute("SELECT courier_id FROM courier WHERE chat_id = ?", (chat_id,))
 
-        courier_id = cursor.fetchone()
-        db.close()
+class DB:
+    def __init__(self):
+        self._backend = get_backend(
+            os.getenv('DATABASE_URL'),
+            min_connections=int(os.getenv('DB_POOL_MIN', 1)),
+            max_connections=int(os.getenv('DB_POOL_MAX', 10)),
+        )
+        self._init_db()
+
+    def _init_db(self):
+        """Initialize database tables by applying pending schema migrations"""
+        with self._backend.connection() as cursor:
+            self._backend.lock_schema(cursor)
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY)")
+            cursor.execute("SELECT MAX(version) FROM schema_migrations")
+            version = cursor.fetchone()[0] or 0
+
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                if isinstance(migration, dict):
+                    migration = migration[self._backend.dialect]
+                for statement in migration:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute("INSERT INTO schema_migrations (version) VALUES (?)", (number,))
+
+    def get_courier_id(self, chat_id):
+        with self._backend.connection() as cursor:
+            cursor.execute("SELECT courier_id FROM courier WHERE chat_id = ?", (chat_id,))
+            courier_id = cursor.fetchone()
 
         if courier_id is None:
             return None
         return courier_id[0]
 
     def add_courier(self, chat_id, courier_id):
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM courier WHERE courier_id = ?", (courier_id,))
-        cursor.execute("DELETE FROM courier WHERE chat_id = ?", (chat_id,))
-        cursor.execute("INSERT INTO courier (chat_id, courier_id) VALUES (?, ?)", (chat_id, courier_id))
-        db.commit()
-        db.close()
+        with self._backend.connection() as cursor:
+            cursor.execute("DELETE FROM courier WHERE courier_id = ?", (courier_id,))
+            cursor.execute("DELETE FROM courier WHERE chat_id = ?", (chat_id,))
+            cursor.execute("INSERT INTO courier (chat_id, courier_id) VALUES (?, ?)", (chat_id, courier_id))
+
+    def get_couriers(self):
+        """Get all registered couriers as a list of (chat_id, courier_id)"""
+        with self._backend.connection() as cursor:
+            cursor.execute("SELECT chat_id, courier_id FROM courier")
+            return cursor.fetchall()
 
     def add_completed_order(self, courier_id, order_id, order_number):
-        """Add a completed order to the database"""
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
+        """Add a completed order to the database
+
+        Returns False if the order has already been recorded as completed.
+        """
+        with self._backend.connection() as cursor:
+            return self._insert_completed_order(cursor, courier_id, order_id, order_number)
+
+    def _insert_completed_order(self, cursor, courier_id, order_id, order_number):
+        # completed_order_ids outlives archiving, so an archived order is not counted twice
+        cursor.execute(
+            "INSERT INTO completed_order_ids (order_id) VALUES (?) ON CONFLICT (order_id) DO NOTHING",
+            (str(order_id),)
+        )
+        if cursor.rowcount == 0:
+            return False
+
         cursor.execute(
-            "INSERT INTO completed_orders (courier_id, order_id, order_number) VALUES (?, ?, ?)",
-            (courier_id, order_id, order_number)
+            """
+            INSERT INTO completed_orders (courier_id, order_id, order_number) VALUES (?, ?, ?)
+            ON CONFLICT (order_id) DO NOTHING
+            """,
+            (courier_id, str(order_id), order_number)
         )
-        db.commit()
-        db.close()
+        return cursor.rowcount > 0
+
+    def add_order_status_change(self, order_id, site, status, courier_id=None, order_number=None):
+        """Queue an order status change for RetailCRM
+
+        If courier_id is given, the order is also recorded as completed by the courier
+        in the same transaction. Returns False if it had already been recorded, the status
+        change is not queued again then.
+        """
+        now = datetime.utcnow()
+        with self._backend.connection() as cursor:
+            if courier_id is not None and not self._insert_completed_order(cursor, courier_id, order_id, order_number):
+                return False
+            cursor.execute(
+                "INSERT INTO crm_outbox (order_id, site, status, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                (str(order_id), site, status, now, now)
+            )
+        return True
+
+    def get_pending_status_changes(self, limit=50):
+        """Claim status changes ready to be sent, only the oldest pending one per order
+
+        Failed changes are skipped, so they do not hold back later changes of the order.
+        """
+        now = datetime.utcnow()
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                """
+                SELECT id, order_id, site, status, attempts
+                FROM crm_outbox
+                WHERE id IN (
+                    SELECT MIN(id) FROM crm_outbox WHERE sent_at IS NULL AND failed_at IS NULL GROUP BY order_id
+                )
+                  AND next_attempt_at <= ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (now, limit)
+            )
+            candidates = cursor.fetchall()
+
+            results = []
+            for change in candidates:
+                cursor.execute(
+                    "UPDATE crm_outbox SET next_attempt_at = ? WHERE id = ? AND sent_at IS NULL AND next_attempt_at <= ?",
+                    (now + timedelta(seconds=OUTBOX_CLAIM_SECONDS), change[0], now)
+                )
+                if cursor.rowcount > 0:
+                    results.append(change)
+        return results
+
+    def mark_status_changes_sent(self, outbox_ids):
+        now = datetime.utcnow()
+        with self._backend.connection() as cursor:
+            cursor.executemany(
+                "UPDATE crm_outbox SET sent_at = ?, last_error = NULL WHERE id = ?",
+                [(now, outbox_id) for outbox_id in outbox_ids]
+            )
+            cursor.execute("DELETE FROM crm_outbox WHERE sent_at < ?", (now - timedelta(days=1),))
+
+    def mark_status_change_failed(self, outbox_id, error, retry_in=None):
+        """Record a failed attempt and postpone the next one by retry_in seconds
+
+        Without retry_in the change is marked as failed and is not sent again.
+        """
+        now = datetime.utcnow()
+        with self._backend.connection() as cursor:
+            if retry_in is None:
+                cursor.execute(
+                    "UPDATE crm_outbox SET attempts = attempts + 1, last_error = ?, failed_at = ? WHERE id = ?",
+                    (str(error), now, outbox_id)
+                )
+            else:
+                cursor.execute(
+                    """
+                    UPDATE crm_outbox
+                    SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+                    WHERE id = ?
+                    """,
+                    (str(error), now + timedelta(seconds=retry_in), outbox_id)
+                )
+
+    def get_outbox_stats(self):
+        """Get the number of unsent and failed status changes and the age of the oldest unsent one in seconds"""
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                """
+                SELECT COUNT(*), MAX(attempts), MIN(created_at)
+                FROM crm_outbox
+                WHERE sent_at IS NULL AND failed_at IS NULL
+                """
+            )
+            pending, max_attempts, oldest = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*) FROM crm_outbox WHERE failed_at IS NOT NULL")
+            failed = cursor.fetchone()[0]
+
+        lag = 0
+        if oldest is not None:
+            lag = max(0, int((datetime.utcnow() - _parse_timestamp(oldest)).total_seconds()))
+        return {'pending': pending, 'failed': failed, 'max_attempts': max_attempts or 0, 'lag_seconds': lag}
+
+    def get_idempotency_result(self, key, ttl=600):
+        """Get the stored result for a key if it was saved less than ttl seconds ago"""
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                "SELECT result FROM idempotency WHERE key = ? AND created_at >= ?",
+                (key, datetime.utcnow() - timedelta(seconds=ttl))
+            )
+            result = cursor.fetchone()
+
+        if result is None:
+            return None
+        return result[0]
+
+    def save_idempotency_result(self, key, result, ttl=600):
+        """Save the result for a key and drop expired records"""
+        now = datetime.utcnow()
+        with self._backend.connection() as cursor:
+            cursor.execute("DELETE FROM idempotency WHERE created_at < ?", (now - timedelta(seconds=ttl),))
+            cursor.execute(
+                """
+                INSERT INTO idempotency (key, result, created_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET result = excluded.result, created_at = excluded.created_at
+                """,
+                (key, result, now)
+            )
+
+    def mark_update_seen(self, update_id):
+        """Remember a Telegram update id, returns False if it has already been seen"""
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                "INSERT INTO seen_updates (update_id, seen_at) VALUES (?, ?) ON CONFLICT (update_id) DO NOTHING",
+                (update_id, datetime.utcnow())
+            )
+            return cursor.rowcount > 0
+
+    def delete_seen_updates(self, older_than=24 * 60 * 60):
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                "DELETE FROM seen_updates WHERE seen_at < ?",
+                (datetime.utcnow() - timedelta(seconds=older_than),)
+            )
+
+    def save_pending_updates(self, updates):
+        """Persist not processed updates as a list of (update_id, payload)"""
+        with self._backend.connection() as cursor:
+            cursor.executemany(
+                "INSERT INTO pending_updates (update_id, payload) VALUES (?, ?) ON CONFLICT (update_id) DO NOTHING",
+                updates
+            )
+
+    def take_pending_updates(self):
+        """Remove and return persisted updates as a list of (update_id, payload), oldest first"""
+        with self._backend.connection() as cursor:
+            cursor.execute("DELETE FROM pending_updates RETURNING update_id, payload")
+            updates = cursor.fetchall()
+        return sorted(updates)
 
     def get_completed_orders_count(self, courier_id, period='day'):
         """Get count of completed orders for a courier in a given period
@@ -93,9 +462,6 @@ class DB:
             courier_id: ID of the courier
             period: 'day', 'week', or 'month'
         """
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
-        
         now = datetime.now()
         
         if period == 'day':
@@ -108,20 +474,69 @@ class DB:
         else:
             start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
         
-        cursor.execute(
-            "SELECT COUNT(*) FROM completed_orders WHERE courier_id = ? AND completed_at >= ?",
-            (courier_id, start_date)
-        )
-        
-        count = cursor.fetchone()[0]
-        db.close()
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM completed_orders WHERE courier_id = ? AND completed_at >= ?",
+                (courier_id, start_date)
+            )
+            count = cursor.fetchone()[0]
+
         return count
 
+    def get_all_couriers_counts(self):
+        """Get completed orders of every courier for today, this week and this month in one pass
+
+        Returns a dict of courier_id -> (day_count, week_count, month_count).
+        """
+        now = datetime.now()
+        day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        week_start = day_start - timedelta(days=now.weekday())
+        month_start = day_start.replace(day=1)
+
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                """
+                SELECT courier_id,
+                       SUM(CASE WHEN completed_at >= ? THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN completed_at >= ? THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN completed_at >= ? THEN 1 ELSE 0 END)
+                FROM completed_orders
+                WHERE completed_at >= ?
+                GROUP BY courier_id
+                """,
+                (day_start, week_start, month_start, min(week_start, month_start))
+            )
+            results = cursor.fetchall()
+
+        return {courier_id: (day_count, week_count, month_count)
+                for courier_id, day_count, week_count, month_count in results}
+
+    def claim_summary(self, run_date, chat_id):
+        """Mark the daily summary for the chat as sent, returns False if it already was"""
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO summary_runs (run_date, chat_id, sent_at) VALUES (?, ?, ?)
+                ON CONFLICT (run_date, chat_id) DO NOTHING
+                """,
+                (run_date, chat_id, datetime.utcnow())
+            )
+            return cursor.rowcount > 0
+
+    def release_summary(self, run_date, chat_id):
+        """Drop the claim of a daily summary that was not sent, so it is sent again"""
+        with self._backend.connection() as cursor:
+            cursor.execute("DELETE FROM summary_runs WHERE run_date = ? AND chat_id = ?", (run_date, chat_id))
+
+    def delete_summary_runs(self, older_than_days=7):
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                "DELETE FROM summary_runs WHERE sent_at < ?",
+                (datetime.utcnow() - timedelta(days=older_than_days),)
+            )
+
     def get_top_couriers(self, period='day', limit=10):
         """Get top couriers by completed orders for a period"""
-        db = sqlite3.connect(self._db_path)
-        cursor = db.cursor()
-        
         now = datetime.now()
         
         if period == 'day':
@@ -134,21 +549,229 @@ class DB:
         else:
             start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
         
+        with self._backend.connection() as cursor:
+            cursor.execute(
+                """
+                SELECT courier_id, COUNT(*) as order_count 
+                FROM completed_orders 
+                WHERE completed_at >= ? 
+                GROUP BY courier_id 
+                ORDER BY order_count DESC 
+                LIMIT ?
+                """,
+                (start_date, limit)
+            )
+            results = cursor.fetchall()
+
+        return results
+
+    def archive_completed_orders(self, keep_months=2):
+        """Move completed orders older than keep_months (including the current one) to monthly archive tables
+
+        The rows of a month are first copied to its archive table, which SQLite keeps in a separate
+        file, then removed from the hot table in one transaction together with adding the per-courier
+        totals to completed_orders_monthly. The copy is idempotent, so a job interrupted in between
+        is finished by the next run. Returns the list of archived months.
+        """
+        cutoff = _month_start(datetime.now())
+        for _ in range(keep_months - 1):
+            cutoff = _month_start(cutoff - timedelta(days=1))
+
+        with self._backend.connection() as cursor:
+            cursor.execute("SELECT MIN(completed_at) FROM completed_orders WHERE completed_at < ?", (cutoff,))
+            oldest = cursor.fetchone()[0]
+        if oldest is None:
+            return []
+
+        archived = []
+        month_start = _month_start(_parse_timestamp(oldest))
+        while month_start < cutoff:
+            month_end = _next_month_start(month_start)
+            month = month_start.strftime('%Y-%m')
+            table_name = f"completed_orders_{month_start:%Y_%m}"
+
+            with self._backend.connection() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM completed_orders WHERE completed_at >= ? AND completed_at < ?",
+                    (month_start, month_end)
+                )
+                if cursor.fetchone()[0] == 0:
+                    month_start = month_end
+                    continue
+
+            self._copy_to_archive(table_name, month_start, month_end)
+
+            with self._backend.connection() as cursor:
+                self._backend.lock_schema(cursor)
+                cursor.execute(
+                    """
+                    INSERT INTO completed_orders_monthly (month, courier_id, order_count)
+                    SELECT ?, courier_id, COUNT(*)
+                    FROM completed_orders
+                    WHERE completed_at >= ? AND completed_at < ?
+                    GROUP BY courier_id
+                    ON CONFLICT (month, courier_id)
+                    DO UPDATE SET order_count = completed_orders_monthly.order_count + excluded.order_count
+                    """,
+                    (month, month_start, month_end)
+                )
+                cursor.execute(
+                    "DELETE FROM completed_orders WHERE completed_at >= ? AND completed_at < ?",
+                    (month_start, month_end)
+                )
+                cursor.execute(
+                    """
+                    INSERT INTO completed_orders_archives (month, table_name, month_start, month_end)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (month) DO NOTHING
+                    """,
+                    (month, table_name, month_start, month_end)
+                )
+
+            archived.append(month)
+            month_start = month_end
+
+        return archived
+
+    def _copy_to_archive(self, table_name, month_start, month_end, batch_size=500):
+        with self._backend.archive_connection(table_name) as archive:
+            archive.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id INTEGER PRIMARY KEY,
+                    courier_id INTEGER,
+                    order_id TEXT,
+                    order_number TEXT,
+                    completed_at TIMESTAMP
+                )
+            """)
+            with self._backend.read_only_connection() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, courier_id, order_id, order_number, completed_at
+                    FROM completed_orders
+                    WHERE completed_at >= ? AND completed_at < ?
+                    """,
+                    (month_start, month_end)
+                )
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    archive.executemany(
+                        f"""
+                        INSERT INTO {table_name} (id, courier_id, order_id, order_number, completed_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (id) DO NOTHING
+                        """,
+                        rows
+                    )
+
+    @contextmanager
+    def _partition_cursor(self, cursor, table_name):
+        """Get a cursor for reading a partition, archives may live outside the main database"""
+        if table_name == 'completed_orders':
+            yield cursor
+        else:
+            with self._backend.archive_connection(table_name, read_only=True) as archive:
+                yield archive
+
+    def _get_partitions(self, cursor, start_date, end_date):
+        """Get tables holding completed orders between the dates: (table_name, month, fully_covered)"""
         cursor.execute(
             """
-            SELECT courier_id, COUNT(*) as order_count 
-            FROM completed_orders 
-            WHERE completed_at >= ? 
-            GROUP BY courier_id 
-            ORDER BY order_count DESC 
-            LIMIT ?
+            SELECT table_name, month, month_start, month_end
+            FROM completed_orders_archives
+            WHERE month_end > ? AND month_start < ?
+            ORDER BY month_start
             """,
-            (start_date, limit)
+            (start_date, end_date)
         )
-        
-        results = cursor.fetchall()
-        db.close()
-        return results
+        partitions = []
+        for table_name, month, month_start, month_end in cursor.fetchall():
+            fully_covered = _parse_timestamp(month_start) >= start_date and _parse_timestamp(month_end) <= end_date
+            partitions.append((table_name, month, fully_covered))
+        partitions.append(('completed_orders', None, False))
+        return partitions
+
+    def get_completed_orders_between(self, start_date, end_date, courier_id=None):
+        """Get completed orders between the dates from the hot table and the monthly archives
+
+        Returns a list of (courier_id, order_id, order_number, completed_at).
+        """
+        return list(self.iter_completed_orders_between(start_date, end_date, courier_id))
+
+    def iter_completed_orders_between(self, start_date, end_date, courier_id=None, batch_size=500):
+        """Yield completed orders between the dates ordered by time, reading in batches on a read-only connection"""
+        courier_filter = " AND courier_id = ?" if courier_id is not None else ""
+        params = (start_date, end_date) + ((courier_id,) if courier_id is not None else ())
+
+        with self._backend.read_only_connection() as cursor:
+            for table_name, _, _ in self._get_partitions(cursor, start_date, end_date):
+                with self._partition_cursor(cursor, table_name) as partition:
+                    partition.execute(
+                        f"""
+                        SELECT courier_id, order_id, order_number, completed_at
+                        FROM {table_name}
+                        WHERE completed_at >= ? AND completed_at < ?{courier_filter}
+                        ORDER BY completed_at
+                        """,
+                        params
+                    )
+                    while True:
+                        rows = partition.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield from rows
+
+    def iter_completed_orders_stats(self, start_date, end_date, period='day'):
+        """Yield (period_start, courier_id, order_count) between the dates
+
+        Orders are streamed in time order, so only the counters of the current period are kept in memory.
+        """
+        current_period = None
+        counts = {}
+        for courier_id, _, _, completed_at in self.iter_completed_orders_between(start_date, end_date):
+            period_start = _period_start(_parse_timestamp(completed_at), period)
+            if period_start != current_period:
+                for counted_courier_id, order_count in sorted(counts.items()):
+                    yield current_period, counted_courier_id, order_count
+                current_period = period_start
+                counts = {}
+            counts[courier_id] = counts.get(courier_id, 0) + 1
+
+        for counted_courier_id, order_count in sorted(counts.items()):
+            yield current_period, counted_courier_id, order_count
+
+    def get_completed_orders_totals_between(self, start_date, end_date):
+        """Get (courier_id, order_count) between the dates across partitions, most orders first
+
+        Archived months fully inside the range are counted from completed_orders_monthly.
+        """
+        totals = {}
+        with self._backend.connection() as cursor:
+            for table_name, month, fully_covered in self._get_partitions(cursor, start_date, end_date):
+                if fully_covered:
+                    cursor.execute(
+                        "SELECT courier_id, order_count FROM completed_orders_monthly WHERE month = ?",
+                        (month,)
+                    )
+                    counts = cursor.fetchall()
+                else:
+                    with self._partition_cursor(cursor, table_name) as partition:
+                        partition.execute(
+                            f"""
+                            SELECT courier_id, COUNT(*)
+                            FROM {table_name}
+                            WHERE completed_at >= ? AND completed_at < ?
+                            GROUP BY courier_id
+                            """,
+                            (start_date, end_date)
+                        )
+                        counts = partition.fetchall()
+                for courier_id, order_count in counts:
+                    totals[courier_id] = totals.get(courier_id, 0) + order_count
+
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
 
     def get_random_motivational_phrase(self):
         """Get a random motivational phrase"""
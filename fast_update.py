@@ -0,0 +1,70 @@
+"""Fast decoding of Telegram updates
+
+Callback handlers only need the callback data, the chat id and the message id,
+so callback queries are wrapped in light objects and the full telebot objects
+are built only when a handler uses any other attribute.
+"""
+import telebot
+
+try:
+    import orjson
+
+    def decode_update(body):
+        """Decode the raw update body (bytes or str) into a dict"""
+        return orjson.loads(body)
+except ImportError:
+    import json
+
+    def decode_update(body):
+        """Decode the raw update body (bytes or str) into a dict"""
+        return json.loads(body)
+
+
+class LazyChat:
+    __slots__ = ('_raw', '_full', 'id')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._full = None
+        self.id = raw['id']
+
+    def __getattr__(self, name):
+        if self._full is None:
+            self._full = telebot.types.Chat.de_json(self._raw)
+        return getattr(self._full, name)
+
+
+class LazyMessage:
+    __slots__ = ('_raw', '_full', 'chat', 'message_id')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._full = None
+        self.chat = LazyChat(raw['chat'])
+        self.message_id = raw['message_id']
+
+    def __getattr__(self, name):
+        if self._full is None:
+            self._full = telebot.types.Message.de_json(self._raw)
+        return getattr(self._full, name)
+
+
+class LazyCallbackQuery:
+    __slots__ = ('_raw', '_full', 'id', 'data', 'message')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._full = None
+        self.id = raw['id']
+        self.data = raw.get('data', '')
+        self.message = LazyMessage(raw['message'])
+
+    def __getattr__(self, name):
+        if self._full is None:
+            self._full = telebot.types.CallbackQuery.de_json(self._raw)
+        return getattr(self._full, name)
+
+
+def get_callback_verb(data):
+    """Get the verb of callback data, e.g. 'ORDER' for 'ORDER;123'"""
+    return data.split(';', 1)[0]
@@ -6,15 +6,32 @@ import retailcrm
 import telebot
 import requests
 import logging
+import threading
+import json
+import queue
+import signal
+import itertools
+import csv
+import hmac
+import io
 
 from dotenv import load_dotenv
 from telebot.types import Message, KeyboardButton, ReplyKeyboardMarkup, CallbackQuery, InputMediaPhoto
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
+from multidimensional_urlencode import urlencode as query_builder
+from retailcrm.response import Response as CrmResponse
+from werkzeug.serving import make_server
 
+from admission import classify_update, CrmLimiter, PRIORITY_HIGH, PRIORITY_LOW
 from db import DB
+from fast_update import decode_update, get_callback_verb, LazyCallbackQuery
+from order_index import OrderIndex
+from utils import FreshClient, SingleFlight
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +40,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+PROCESS_STARTED_AT = time.monotonic()
+
 load_dotenv()
 locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
 
@@ -45,15 +64,127 @@ adapter = HTTPAdapter(max_retries=retry_strategy)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
 
+# RetailCRM calls hold a CRM slot, so only failed connections are retried, never a slow answer
+crm_session = requests.Session()
+crm_adapter = HTTPAdapter(max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.5))
+crm_session.mount("http://", crm_adapter)
+crm_session.mount("https://", crm_adapter)
+
+
+class RetailCrmClient(retailcrm.v5):
+    """RetailCRM v5 client sending requests through crm_session with API_TIMEOUT
+
+    The library calls requests without a timeout, so a hung connection would hold a CRM slot forever.
+    """
+
+    def get(self, url, version=True):
+        base_url = self.api_url + '/' + self.api_version if version else self.api_url
+        requests_url = base_url + url if not self.parameters else base_url + url + "?" + query_builder(self.parameters)
+        response = crm_session.get(requests_url, headers={'X-API-KEY': self.api_key}, timeout=API_TIMEOUT)
+        return CrmResponse(response.status_code, response.json())
+
+    def post(self, url, version=True):
+        base_url = self.api_url + '/' + self.api_version if version else self.api_url
+        response = crm_session.post(
+            base_url + url, data=self.parameters, headers={'X-API-KEY': self.api_key}, timeout=API_TIMEOUT
+        )
+        return CrmResponse(response.status_code, response.json())
+
 WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_HOSTNAME')
 WEBHOOK_PORT = int(os.getenv('PORT', 10000))
 TG_TOKEN = os.getenv('TG_TOKEN')
 WEBHOOK_URL = f"https://{WEBHOOK_HOST}/{TG_TOKEN}" if WEBHOOK_HOST and TG_TOKEN else None
 
+# Order list paging: per-chat cursor over the fetched order ids
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', 10))
+ORDERS_CURSOR_TTL = 30 * 60
+orders_cursors = {}
+orders_cursors_lock = threading.Lock()
+
+# Background prefetch of order cards for the opened order list
+PREFETCH_MAX_ORDERS = int(os.getenv('PREFETCH_MAX_ORDERS', 20))
+PREFETCH_MAX_PENDING = 50
+PREFETCH_TTL = 3 * 60
+prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+prefetch_store = {}
+prefetch_futures = {}
+prefetch_lock = threading.Lock()
+
+# Coalescing of repeated "Доставлен"/"Возврат" taps
+APPROVE_IDEMPOTENCY_TTL = 10 * 60
+approve_flight = SingleFlight()
+
+# Write-behind sending of order status changes to RetailCRM
+OUTBOX_INTERVAL = 5
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_RETRY_DELAY = 10 * 60
+OUTBOX_MAX_ATTEMPTS = 10
+outbox_wakeup = threading.Event()
+
+# Archival of completed orders older than the previous month
+ARCHIVE_INTERVAL = 6 * 60 * 60
+
+# Cached reference data from RetailCRM
+PAYMENT_TYPES_TTL = 60 * 60
+payment_types_cache = {'names': None, 'fetched_at': 0}
+payment_types_lock = threading.Lock()
+
+# Update intake: updates from the webhook or polling are processed by own workers,
+# so a stopping instance can drain them and persist the rest for the next one
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 4))
+SHUTDOWN_DEADLINE = int(os.getenv('SHUTDOWN_DEADLINE', 20))
+# The previous instance persists its leftovers when it stops, which is after this one has started
+PENDING_UPDATES_INTERVAL = 5
+update_queue = queue.PriorityQueue()
+update_sequence = itertools.count()
+accepting_updates = threading.Event()
+shutting_down = threading.Event()
+# Set once the database is connected and migrated, see init_storage
+storage_ready = threading.Event()
+# How long a webhook request arriving during startup waits for the database
+STORAGE_WAIT_TIMEOUT = 5
+# Accepted updates waiting in the queue and updates being processed, by update_id
+queued_updates = {}
+running_updates = {}
+updates_state_lock = threading.Lock()
+fast_callback_handlers = {}
+
+# Load shedding: low priority updates get a "busy" reply when the queue or RetailCRM is slow,
+# under heavy overload only delivery and return confirmations are processed
+CRM_MAX_CONCURRENT = int(os.getenv('CRM_MAX_CONCURRENT', 4))
+# Slots only delivery and return confirmations and the outbox sender may use
+CRM_RESERVED_SLOTS = int(os.getenv('CRM_RESERVED_SLOTS', 1))
+CRM_LATENCY_LIMIT = float(os.getenv('CRM_LATENCY_LIMIT', 3))
+QUEUE_SOFT_LIMIT = int(os.getenv('QUEUE_SOFT_LIMIT', 20))
+QUEUE_HARD_LIMIT = int(os.getenv('QUEUE_HARD_LIMIT', 100))
+BUSY_TEXT = 'Сейчас много запросов, попробуйте через минуту 🙏'
+busy_reply_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='busy-reply')
+shed_counter = itertools.count(1)
+load_stats = {'shed': 0}
+
+# Inline search: per-courier index over the orders already fetched for the courier
+ORDER_INDEX_TTL = 5 * 60
+order_indexes = {}
+order_indexes_lock = threading.Lock()
+order_index_flight = SingleFlight()
+
+# Daily end-of-shift summaries, disabled if SUMMARY_TIME is empty. The time is in the container's
+# time zone like the day boundaries of the stats, on Render it is UTC: 18:00 is 21:00 in Moscow
+SUMMARY_TIME = os.getenv('SUMMARY_TIME', '18:00')
+SUMMARY_SEND_INTERVAL = 0.05
+SUMMARY_CHECK_INTERVAL = 60
+
+# Statistics export for dispatchers, disabled if EXPORT_TOKEN is not set
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')
+EXPORT_CHUNK_ROWS = 500
+
+# Startup timings in seconds since the module was loaded, reported on /health
+startup_metrics = {}
+
 
 def init_bot():
-    """Initialize bot and client"""
-    global client, db, bot
+    """Initialize bot and client, the database is set up separately by init_storage"""
+    global client, bot
     
     logger.info("Initializing bot...")
     
@@ -64,9 +195,15 @@ def init_bot():
         return False
     
     try:
-        client = retailcrm.v5(os.getenv('RETAIL_URL'), os.getenv('RETAIL_KEY'))
-        db = DB()
-        bot = telebot.TeleBot(os.getenv('TG_TOKEN'))
+        # Every call gets its own retailcrm client, see FreshClient
+        client = CrmLimiter(
+            FreshClient(lambda: RetailCrmClient(os.getenv('RETAIL_URL'), os.getenv('RETAIL_KEY'))),
+            CRM_MAX_CONCURRENT,
+            reserved=CRM_RESERVED_SLOTS,
+            acquire_timeout=API_TIMEOUT,
+        )
+        # Handlers run in the update workers, see update_worker
+        bot = telebot.TeleBot(os.getenv('TG_TOKEN'), threaded=False)
         
         # Register handlers
         register_handlers()
@@ -78,6 +215,34 @@ def init_bot():
         return False
 
 
+def init_storage():
+    """Connect to the database, apply migrations and start the background workers
+
+    Updates are accepted only after this, the webhook waits for it up to STORAGE_WAIT_TIMEOUT.
+    """
+    global db
+
+    try:
+        db = DB()
+        threading.Thread(target=outbox_sender_loop, name='outbox-sender', daemon=True).start()
+        threading.Thread(target=maintenance_loop, name='maintenance', daemon=True).start()
+        if SUMMARY_TIME:
+            threading.Thread(target=summary_loop, name='summary', daemon=True).start()
+        start_update_workers()
+        storage_ready.set()
+        record_startup_metric('storage_ready_seconds')
+        return True
+    except Exception as e:
+        logger.error(f"Failed to initialize storage: {e}")
+        return False
+
+
+def init_storage_or_exit():
+    if not init_storage():
+        logging.shutdown()
+        os._exit(1)
+
+
 def register_handlers():
     """Register all bot handlers"""
     
@@ -152,6 +317,44 @@ def register_handlers():
             logger.error(f"Error in auth: {e}")
             bot.send_message(message.chat.id, "Ошибка авторизации. Попробуйте позже.")
 
+    @bot.message_handler(commands=['order'])
+    def order_command(message: Message):
+        """Open an order card by id, sent by choosing an inline search result"""
+        try:
+            parts = message.text.split()
+            if len(parts) < 2:
+                return
+
+            placeholder = bot.send_message(message.chat.id, 'Загружаю заказ...')
+            order_info(SimpleNamespace(data=f'ORDER;{parts[1]}', message=placeholder))
+        except Exception as e:
+            logger.error(f"Error in order command: {e}")
+
+    @bot.inline_handler(lambda query: True)
+    def search_orders(query):
+        """Search the courier's active orders by number, address or recipient"""
+        try:
+            courier = db.get_courier_id(query.from_user.id)
+            if courier is None:
+                bot.answer_inline_query(query.id, [], cache_time=0, is_personal=True)
+                return
+
+            results = []
+            for entry in get_fresh_order_index(courier).search(query.query):
+                description = entry['address']
+                if entry['recipient']:
+                    description += f"\nПолучатель: {entry['recipient']}"
+                results.append(telebot.types.InlineQueryResultArticle(
+                    id=entry['id'],
+                    title=f"Заказ {entry['number']} ({entry['delivery_date']})",
+                    description=description,
+                    input_message_content=telebot.types.InputTextMessageContent(f"/order {entry['id']}"),
+                ))
+
+            bot.answer_inline_query(query.id, results, cache_time=0, is_personal=True)
+        except Exception as e:
+            logger.error(f"Error in search_orders: {e}")
+
     @bot.callback_query_handler(lambda call: 'menu' in call.data)
     def menu(call):
         send_menu(call.message)
@@ -230,57 +433,19 @@ def register_handlers():
                 starter(call.message)
                 return
 
-            day_orders = []
-            limit = 100
-            page = 1
-            max_pages = 10
-
-            while page <= max_pages:
-                try:
-                    answer = client.orders(
-                        filters={
-                            'extendedStatus': ['dostavliaet-kurer-ash', 'dostavliaet-kurer-iandeks'],
-                            'deliveryTypes': ['yandex', 'kurer-ash'],
-                            'couriers': [courier],
-                        },
-                        limit=limit,
-                        page=page
-                    ).get_response()
-                    
-                    for order in answer['orders']:
-                        day_orders.append(order)
-
-                    if len(answer['orders']) < limit:
-                        break
-                    page += 1
-                except Exception as e:
-                    logger.error(f"Error fetching orders page {page}: {e}")
-                    break
+            day_orders, complete = fetch_courier_orders(courier)
+            # A partial list would drop the missing orders from inline search
+            if complete:
+                get_order_index(courier).replace(day_orders)
 
             if not day_orders:
                 bot.send_message(call.message.chat.id, f'Доставляемых вами заказов пока нет')
                 send_menu(call.message)
                 return
 
-            markup = telebot.types.InlineKeyboardMarkup()
-            for order in day_orders:
-                order_number = order['number']
-
-                delivery_date = order.get('delivery', {}).get('date', '?')
-
-                delivery_time = order.get('delivery', {}).get('time', {})
-                delivery_time_from = delivery_time.get('from', '?')
-                delivery_time_to = delivery_time.get('to', '?')
-                delivery_time = f"{delivery_time_from}-{delivery_time_to}"
-
-                button = telebot.types.InlineKeyboardButton(
-                    text=f"{order_number} ({delivery_date} {delivery_time})",
-                    callback_data=f'ORDER;{order["id"]}'
-                )
-                markup.add(button)
-
-            button = telebot.types.InlineKeyboardButton(text='Назад', callback_data='menu')
-            markup.add(button)
+            page = set_orders_cursor(call.message.chat.id, day_orders)
+            prefetch_orders(call.message.chat.id, day_orders)
+            markup = build_orders_markup(call.message.chat.id, page)
 
             bot.send_message(call.message.chat.id, f'Собранные для вас заказы:', reply_markup=markup)
         except Exception as e:
@@ -288,6 +453,25 @@ def register_handlers():
             bot.send_message(call.message.chat.id, "Ошибка при получении заказов. Попробуйте позже.")
             send_menu(call.message)
 
+    @bot.callback_query_handler(lambda call: call.data.startswith('ORDERS_PAGE;'))
+    def orders_page(call):
+        """Turn the order list page using the cached cursor, without querying RetailCRM"""
+        try:
+            if call.data == 'ORDERS_PAGE;-':
+                bot.answer_callback_query(call.id)
+                return
+
+            page = int(call.data.split(';')[1])
+            markup = build_orders_markup(call.message.chat.id, page)
+            if markup is None:
+                # Cursor expired (e.g. after restart) - fetch the list again
+                get_orders(call)
+                return
+
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+        except Exception as e:
+            logger.error(f"Error in orders_page: {e}")
+
     @bot.callback_query_handler(lambda call: 'ORDER;' in call.data)
     def order_info(call):
         try:
@@ -301,14 +485,19 @@ def register_handlers():
             order_id = call.data.split(';')[1]
             logger.info(f"Fetching order {order_id} for courier {courier}")
             
-            try:
-                order = client.order(order_id, 'id').get_response()['order']
-                logger.info(f"Order {order_id} fetched successfully")
-            except Exception as e:
-                logger.error(f"Error fetching order {order_id} from API: {e}")
-                bot.send_message(call.message.chat.id, 'Не удалось получить информацию о заказе из системы. Попробуйте позже.')
-                send_menu(call.message)
-                return
+            prefetched = get_prefetched_order(order_id)
+            if prefetched is not None:
+                order = prefetched['order']
+                logger.info(f"Order {order_id} served from prefetch")
+            else:
+                try:
+                    order = client.order(order_id, 'id').get_response()['order']
+                    logger.info(f"Order {order_id} fetched successfully")
+                except Exception as e:
+                    logger.error(f"Error fetching order {order_id} from API: {e}")
+                    bot.send_message(call.message.chat.id, 'Не удалось получить информацию о заказе из системы. Попробуйте позже.')
+                    send_menu(call.message)
+                    return
 
             if order['delivery']['data']['courierId'] != courier:
                 logger.warning(f"Order {order_id} courier mismatch: {order['delivery']['data']['courierId']} != {courier}")
@@ -323,8 +512,11 @@ def register_handlers():
                 return
 
             try:
-                order_text = f"Заказ: <b>{order['number']}</b>\n"
-                order_text += get_order_text(order)
+                if prefetched is not None:
+                    order_text = prefetched['text']
+                else:
+                    order_text = f"Заказ: <b>{order['number']}</b>\n"
+                    order_text += get_order_text(order)
                 logger.info(f"Order text generated for order {order_id}")
             except Exception as e:
                 logger.error(f"Error generating order text for {order_id}: {e}")
@@ -360,7 +552,10 @@ def register_handlers():
             markup.add(button2, button3)
 
             try:
-                order_photos = get_order_photos(order)
+                if prefetched is not None:
+                    order_photos = prefetched['photos']
+                else:
+                    order_photos = get_order_photos(order)
                 logger.info(f"Got {len(order_photos)} photos for order {order_id}")
             except Exception as e:
                 logger.error(f"Error getting order photos for {order_id}: {e}")
@@ -450,30 +645,53 @@ def register_handlers():
                 return
 
             order_id = call.data.split(';')[1]
+            command = call.data.split(';')[2]
+            key = f'{order_id};{command}'
+
+            # Late retry of an already processed tap - answer without touching the CRM
+            result = db.get_idempotency_result(key, APPROVE_IDEMPOTENCY_TTL)
+            if result is not None:
+                logger.info(f"Order {order_id} {command} already processed")
+                bot.answer_callback_query(call.id, result)
+                return
+
+            # Concurrent duplicate taps share one execution
+            result, shared = approve_flight.do(key, lambda: process_order_approve(call, courier, order_id, command))
+            if shared:
+                logger.info(f"Order {order_id} {command} coalesced with in-flight request")
+                bot.answer_callback_query(call.id, result or 'Заказ уже обрабатывается')
+        except Exception as e:
+            logger.error(f"Error in order_approve: {e}")
 
+    def process_order_approve(call, courier, order_id, command):
+        """Change the order status, returns a short result text or None if not processed"""
+        try:
             order = client.order(order_id, 'id').get_response()['order']
 
             if order['delivery']['data']['courierId'] != courier:
                 bot.send_message(call.message.chat.id, 'Что-то пошло не так, выберите заказ повторно:')
                 send_menu(call.message)
-                return
+                return None
 
             if order['status'] not in ['dostavliaet-kurer-ash', 'dostavliaet-kurer-iandeks']:
                 bot.send_message(call.message.chat.id, 'Что-то пошло не так, выберите заказ повторно:')
                 send_menu(call.message)
-                return
+                return None
 
-            command = call.data.split(';')[2]
-
-            new_status = '-'
             order_photos = []
             text_message = ''
+            result = ''
 
             if command == 'DELIVERY':
                 new_status = 'zakaz-dostavlen'
                 
-                # Track completed order
-                db.add_completed_order(courier, order_id, order['number'])
+                # Track completed order and queue the CRM status change in one transaction
+                if not db.add_order_status_change(order_id, order['site'], new_status, courier, order['number']):
+                    # Confirmed earlier, its status change is already queued
+                    logger.info(f"Order {order_id} already recorded as delivered")
+                    result = f"Заказ {order['number']} уже отмечен доставленным"
+                    bot.answer_callback_query(call.id, result)
+                    return result
                 
                 # Get motivational phrase
                 motivational = db.get_random_motivational_phrase()
@@ -491,19 +709,22 @@ def register_handlers():
                 text_message += f"  За месяц: {month_count} заказов\n\n"
                 text_message += get_order_text(order)
                 order_photos = get_order_photos(order)
+                result = f"✅ Заказ {order['number']} доставлен"
             elif command == 'CANCEL':
                 new_status = 'vozvrat-im'
+                db.add_order_status_change(order_id, order['site'], new_status)
                 text_message = f"❌ Вы вернули заказ {order['number']}"
                 order_photos = []
+                result = text_message
+            else:
+                logger.warning(f"Unknown order_approve command: {command}")
+                return None
 
-            client.order_edit(
-                {
-                    'id': order['id'],
-                    'status': new_status,
-                },
-                'id',
-                order['site']
-            )
+            # The status is sent to RetailCRM by the outbox sender
+            outbox_wakeup.set()
+            drop_prefetched_order(order_id)
+            get_order_index(courier).remove(order_id)
+            db.save_idempotency_result(f'{order_id};{command}', result, APPROVE_IDEMPOTENCY_TTL)
 
             if order_photos:
                 media = [InputMediaPhoto(photo) for photo in order_photos]
@@ -515,10 +736,610 @@ def register_handlers():
                 bot.delete_message(call.message.chat.id, call.message.message_id)
                 bot.send_message(call.message.chat.id, text_message, parse_mode='HTML')
             send_menu(call.message, need_delete_massage=False)
+            return result
         except Exception as e:
             logger.error(f"Error in order_approve: {e}")
             bot.send_message(call.message.chat.id, "Ошибка при обработке заказа. Попробуйте позже.")
             send_menu(call.message)
+            return None
+
+    # Hot callback verbs are routed on the raw update fields, see dispatch_update
+    fast_callback_handlers.update({
+        'menu': menu,
+        'my_rating': my_rating_callback,
+        'get_orders': get_orders,
+        'ORDERS_PAGE': orders_page,
+        'ORDER': order_info,
+        'CALL_CUSTOMER': call_customer,
+        'ORDER_APPROVE': order_approve,
+    })
+
+
+def outbox_sender_loop():
+    """Send queued order status changes to RetailCRM"""
+    while True:
+        outbox_wakeup.wait(OUTBOX_INTERVAL)
+        outbox_wakeup.clear()
+        try:
+            with client.priority(PRIORITY_HIGH):
+                while flush_outbox() >= OUTBOX_BATCH_SIZE:
+                    pass
+        except Exception as e:
+            logger.error(f"Error in outbox sender: {e}")
+
+
+def flush_outbox():
+    """Send one batch of status changes, returns the number of processed entries
+
+    Only the oldest unsent change of each order is taken, so changes of one order
+    are applied in order. Failed changes are retried with exponential backoff,
+    after OUTBOX_MAX_ATTEMPTS attempts the change is marked as failed and is left
+    for a dispatcher, it is counted in /health.
+    """
+    changes = db.get_pending_status_changes(OUTBOX_BATCH_SIZE)
+    sent_ids = []
+    for outbox_id, order_id, site, status, attempts in changes:
+        try:
+            response = client.order_edit({'id': order_id, 'status': status}, 'id', site)
+            if not response.is_successful():
+                raise Exception(response.get_error_msg())
+            sent_ids.append(outbox_id)
+            logger.info(f"Order {order_id} status {status} sent to CRM")
+        except Exception as e:
+            if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Giving up on order {order_id} status {status} after {attempts + 1} attempts: {e}")
+                db.mark_status_change_failed(outbox_id, e)
+                continue
+            retry_in = min(5 * 2 ** attempts, OUTBOX_MAX_RETRY_DELAY)
+            logger.error(f"Error sending order {order_id} status {status} to CRM, retry in {retry_in}s: {e}")
+            db.mark_status_change_failed(outbox_id, e, retry_in)
+
+    if sent_ids:
+        db.mark_status_changes_sent(sent_ids)
+    return len(changes)
+
+
+def maintenance_loop():
+    """Keep only the current and previous month in the completed_orders table and drop old update ids"""
+    while True:
+        try:
+            archived = db.archive_completed_orders(keep_months=2)
+            if archived:
+                logger.info(f"Archived completed orders for months: {', '.join(archived)}")
+        except Exception as e:
+            logger.error(f"Error archiving completed orders: {e}")
+
+        try:
+            db.delete_seen_updates()
+            db.delete_summary_runs()
+        except Exception as e:
+            logger.error(f"Error deleting old records: {e}")
+        time.sleep(ARCHIVE_INTERVAL)
+
+
+def summary_loop():
+    """Send the daily summary once SUMMARY_TIME has passed, resuming an interrupted run after restart"""
+    summary_time = datetime.strptime(SUMMARY_TIME, '%H:%M').time()
+    last_run_date = None
+    while True:
+        now = datetime.now()
+        run_date = now.strftime('%Y-%m-%d')
+        if now.time() >= summary_time and run_date != last_run_date:
+            try:
+                # Chats that failed are retried on the next check
+                if send_daily_summaries(run_date) == 0:
+                    last_run_date = run_date
+            except Exception as e:
+                logger.error(f"Error sending daily summaries: {e}")
+        time.sleep(SUMMARY_CHECK_INTERVAL)
+
+
+def send_daily_summaries(run_date):
+    """Send every courier their stats for the day, week and month and their position for today
+
+    Stats of all couriers are computed with one query. Every chat is claimed in the database
+    before sending, so a restarted or second instance does not send the summary twice. The claim
+    is released if sending fails, returns the number of such chats.
+    """
+    couriers_counts = db.get_all_couriers_counts()
+    day_ranking = sorted(
+        ((courier_id, counts[0]) for courier_id, counts in couriers_counts.items() if counts[0] > 0),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    day_positions = {courier_id: position for position, (courier_id, _) in enumerate(day_ranking, 1)}
+
+    sent = 0
+    failed = 0
+    for chat_id, courier_id in db.get_couriers():
+        if not db.claim_summary(run_date, chat_id):
+            continue
+
+        day_count, week_count, month_count = couriers_counts.get(courier_id, (0, 0, 0))
+        message = "🌙 <b>Итоги смены</b>\n\n"
+        message += "📊 <b>Статистика доставок:</b>\n"
+        message += f"  Сегодня: {day_count} заказов\n"
+        message += f"  За неделю: {week_count} заказов\n"
+        message += f"  За месяц: {month_count} заказов\n\n"
+        if courier_id in day_positions:
+            message += f"⭐ <b>Ваша позиция за сегодня:</b> #{day_positions[courier_id]} место\n"
+        else:
+            message += "⭐ Продолжайте работать, чтобы попасть в топ!\n"
+
+        try:
+            send_paced_message(chat_id, message)
+            sent += 1
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code in (400, 403):
+                # Chat is gone or the bot is blocked, retrying will not help
+                logger.warning(f"Daily summary not delivered to chat {chat_id}: {e}")
+            else:
+                logger.error(f"Error sending daily summary to chat {chat_id}: {e}")
+                db.release_summary(run_date, chat_id)
+                failed += 1
+        except Exception as e:
+            logger.error(f"Error sending daily summary to chat {chat_id}: {e}")
+            db.release_summary(run_date, chat_id)
+            failed += 1
+        time.sleep(SUMMARY_SEND_INTERVAL)
+
+    if sent:
+        logger.info(f"Daily summary for {run_date} sent to {sent} couriers")
+    if failed:
+        logger.warning(f"Daily summary for {run_date} failed for {failed} couriers, will retry")
+    return failed
+
+
+def send_paced_message(chat_id, message):
+    """Send a message, waiting once for the time Telegram asks for when rate limited"""
+    try:
+        bot.send_message(chat_id, message, parse_mode='HTML')
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code != 429:
+            raise
+        retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+        logger.warning(f"Rate limited by Telegram, retrying in {retry_after}s")
+        time.sleep(retry_after)
+        bot.send_message(chat_id, message, parse_mode='HTML')
+
+
+def start_update_workers():
+    """Start update workers and resume updates persisted by a previously stopped instance"""
+    for i in range(UPDATE_WORKERS):
+        threading.Thread(target=update_worker, name=f'update-worker-{i}', daemon=True).start()
+
+    resume_pending_updates()
+    threading.Thread(target=pending_updates_loop, name='pending-updates', daemon=True).start()
+
+    if not shutting_down.is_set():
+        accepting_updates.set()
+
+
+def pending_updates_loop():
+    """Keep picking up updates persisted by a previous instance, it stops after this one has started"""
+    while not shutting_down.is_set():
+        time.sleep(PENDING_UPDATES_INTERVAL)
+        resume_pending_updates()
+
+
+def resume_pending_updates():
+    try:
+        # Taken under the lock, so a concurrent shutdown persists them again rather than losing them
+        with updates_state_lock:
+            if shutting_down.is_set():
+                return
+            updates = [json.loads(payload) for update_id, payload in db.take_pending_updates()]
+            for update in updates:
+                queued_updates[update['update_id']] = update
+        for update in updates:
+            update_queue.put((classify_update(update), next(update_sequence), update))
+        if updates:
+            logger.info(f"Resumed {len(updates)} updates from the previous instance")
+    except Exception as e:
+        logger.error(f"Error resuming pending updates: {e}")
+
+
+def accept_update(update):
+    """Queue a raw update, skipping updates already accepted by this or another instance
+
+    Returns False if updates are not accepted because the instance is starting up or stopping.
+    """
+    if not accepting_updates.is_set():
+        return False
+
+    update_id = update.get('update_id')
+    if update_id is not None and not db.mark_update_seen(update_id):
+        logger.info(f"Skipping duplicate update {update_id}")
+        return True
+
+    priority = classify_update(update)
+    if priority > get_shed_priority():
+        load_stats['shed'] = next(shed_counter)
+        logger.warning(f"Overloaded, shedding update {update_id} with priority {priority}")
+        busy_reply_executor.submit(reply_busy, update)
+        return True
+
+    enqueue_update(update, priority)
+    return True
+
+
+def enqueue_update(update, priority=None):
+    if priority is None:
+        priority = classify_update(update)
+    with updates_state_lock:
+        queued_updates[update['update_id']] = update
+    # The sequence number keeps updates of the same priority in arrival order
+    update_queue.put((priority, next(update_sequence), update))
+
+
+def get_shed_priority():
+    """Get the lowest priority that is still admitted under the current load"""
+    queued = update_queue.qsize()
+    if queued >= QUEUE_HARD_LIMIT:
+        return PRIORITY_HIGH
+    if queued >= QUEUE_SOFT_LIMIT or client.latency >= CRM_LATENCY_LIMIT:
+        return PRIORITY_LOW - 1
+    return PRIORITY_LOW
+
+
+def is_overloaded():
+    return get_shed_priority() < PRIORITY_LOW
+
+
+def reply_busy(update):
+    try:
+        callback_query = update.get('callback_query')
+        if callback_query is not None:
+            bot.answer_callback_query(callback_query['id'], BUSY_TEXT)
+            return
+
+        message = update.get('message')
+        if message is not None:
+            bot.send_message(message['chat']['id'], BUSY_TEXT)
+    except Exception as e:
+        logger.error(f"Error sending busy reply: {e}")
+
+
+def update_worker():
+    while True:
+        priority, _, update = update_queue.get()
+        # Once an update is started it is never persisted for the next instance, see drain_and_exit
+        with updates_state_lock:
+            queued_updates.pop(update['update_id'], None)
+            running_updates[update['update_id']] = update
+        try:
+            with client.priority(priority):
+                dispatch_update(update)
+        except Exception as e:
+            logger.error(f"Error processing update {update.get('update_id')}: {e}")
+        finally:
+            with updates_state_lock:
+                running_updates.pop(update['update_id'], None)
+            update_queue.task_done()
+
+
+def dispatch_update(update):
+    """Route callbacks with a known verb directly, other updates go through telebot"""
+    callback_query = update.get('callback_query')
+    if callback_query is not None and 'message' in callback_query:
+        handler = fast_callback_handlers.get(get_callback_verb(callback_query.get('data', '')))
+        if handler is not None:
+            handler(LazyCallbackQuery(callback_query))
+            return
+
+    bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+
+def shutdown(signum=None, frame=None):
+    """Signal handler: drain updates in the background, the main thread keeps answering the webhook with 503"""
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    logger.info("Shutting down: no longer accepting updates")
+    accepting_updates.clear()
+    threading.Thread(target=drain_and_exit, name='shutdown').start()
+
+
+def drain_and_exit():
+    """Let accepted updates finish until the deadline, persist the not started ones and exit
+
+    Updates still in progress at the deadline may have sent some replies already, they are
+    dropped and logged rather than processed twice.
+    """
+    deadline = time.monotonic() + SHUTDOWN_DEADLINE
+    while (queued_updates or running_updates) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    # The lock is held until exit, so no worker starts an update after it has been persisted
+    updates_state_lock.acquire()
+    left = [(update_id, json.dumps(update)) for update_id, update in queued_updates.items()]
+    if left:
+        try:
+            db.save_pending_updates(left)
+            logger.warning(f"Persisted {len(left)} not started updates for the next instance")
+        except Exception as e:
+            logger.error(f"Error persisting pending updates: {e}")
+    if running_updates:
+        logger.warning(f"Dropped {len(running_updates)} updates still in progress: {', '.join(map(str, running_updates))}")
+
+    logger.info("Shutdown complete")
+    logging.shutdown()
+    os._exit(0)
+
+
+def poll_updates():
+    """Receive updates with long polling, taking over from a previous instance"""
+    # A webhook set by a previous instance blocks getUpdates, pending updates are kept
+    if bot.get_webhook_info().url:
+        logger.info("Removing webhook to switch to polling")
+        bot.remove_webhook()
+
+    offset = None
+    while True:
+        if shutting_down.is_set():
+            # Updates are not confirmed any more, the next instance receives them
+            time.sleep(1)
+            continue
+
+        try:
+            updates = telebot.apihelper.get_updates(TG_TOKEN, offset=offset, timeout=30, long_polling_timeout=30)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 409:
+                # Another instance is still polling, wait until it stops
+                logger.info("Another instance is polling, retrying in 1 second")
+                time.sleep(1)
+                continue
+            raise
+
+        for update in updates:
+            if not accept_update(update):
+                break
+            offset = update['update_id'] + 1
+
+
+def get_payment_type_names():
+    """Get payment type names by code, cached for PAYMENT_TYPES_TTL"""
+    with payment_types_lock:
+        if payment_types_cache['names'] is not None and \
+                time.time() - payment_types_cache['fetched_at'] < PAYMENT_TYPES_TTL:
+            return payment_types_cache['names']
+
+    payment_types = client.payment_types().get_response()['paymentTypes']
+    payment_type_names = {}
+    for payment_type_code, payment_type in payment_types.items():
+        payment_type_names[payment_type['code']] = payment_type['name']
+
+    with payment_types_lock:
+        payment_types_cache['names'] = payment_type_names
+        payment_types_cache['fetched_at'] = time.time()
+    return payment_type_names
+
+
+def record_startup_metric(name):
+    """Record seconds since start for a startup stage, only the first time"""
+    if name not in startup_metrics:
+        startup_metrics[name] = round(time.monotonic() - PROCESS_STARTED_AT, 3)
+        logger.info(f"Startup metric {name}: {startup_metrics[name]}s")
+
+
+def setup_webhook():
+    """Register the webhook only if Telegram has a different one"""
+    try:
+        webhook_info = bot.get_webhook_info()
+        if webhook_info.url != WEBHOOK_URL:
+            logger.info(f"Setting up webhook at {WEBHOOK_URL}")
+            result = bot.set_webhook(url=WEBHOOK_URL)
+            logger.info(f"Webhook set up result: {result}")
+        else:
+            logger.info("Webhook is already set up")
+        record_startup_metric('webhook_ready_seconds')
+    except Exception as e:
+        logger.error(f"Webhook setup error: {e}")
+
+
+def warm_up():
+    """Load reference data in the background so the first order card does not wait for it"""
+    try:
+        get_payment_type_names()
+        record_startup_metric('warm_up_seconds')
+    except Exception as e:
+        logger.error(f"Error warming up reference data: {e}")
+
+
+def get_order_index(courier):
+    with order_indexes_lock:
+        index = order_indexes.get(courier)
+        if index is None:
+            index = order_indexes[courier] = OrderIndex()
+        return index
+
+
+def get_fresh_order_index(courier):
+    """Get the courier's order index, fetching the orders only if it is older than ORDER_INDEX_TTL
+
+    Concurrent queries (one per keystroke) share a single fetch. If the fetch fails,
+    the previous entries are kept.
+    """
+    index = get_order_index(courier)
+    if time.time() - index.updated_at >= ORDER_INDEX_TTL:
+        order_index_flight.do(courier, lambda: refresh_order_index(courier, index))
+    return index
+
+
+def refresh_order_index(courier, index):
+    orders, complete = fetch_courier_orders(courier)
+    if complete:
+        index.replace(orders)
+    else:
+        logger.warning(f"Order index of courier {courier} is kept, the orders were fetched partially")
+
+
+def fetch_courier_orders(courier):
+    """Fetch all orders currently delivered by the courier from RetailCRM
+
+    Returns the orders and whether all pages were fetched, on error the orders fetched so far are returned.
+    """
+    day_orders = []
+    limit = 100
+    page = 1
+    max_pages = 10
+
+    while page <= max_pages:
+        try:
+            answer = client.orders(
+                filters={
+                    'extendedStatus': ['dostavliaet-kurer-ash', 'dostavliaet-kurer-iandeks'],
+                    'deliveryTypes': ['yandex', 'kurer-ash'],
+                    'couriers': [courier],
+                },
+                limit=limit,
+                page=page
+            ).get_response()
+
+            for order in answer['orders']:
+                day_orders.append(order)
+
+            if len(answer['orders']) < limit:
+                break
+            page += 1
+        except Exception as e:
+            logger.error(f"Error fetching orders page {page}: {e}")
+            return day_orders, False
+
+    return day_orders, True
+
+
+def get_order_button_text(order):
+    order_number = order['number']
+
+    delivery_date = order.get('delivery', {}).get('date', '?')
+
+    delivery_time = order.get('delivery', {}).get('time', {})
+    delivery_time_from = delivery_time.get('from', '?')
+    delivery_time_to = delivery_time.get('to', '?')
+    delivery_time = f"{delivery_time_from}-{delivery_time_to}"
+
+    return f"{order_number} ({delivery_date} {delivery_time})"
+
+
+def set_orders_cursor(chat_id, orders):
+    """Store the fetched order list for the chat and return the page to show
+
+    The current page is kept when the list is refreshed (e.g. "Назад" from an order card).
+    """
+    entries = [(str(order['id']), get_order_button_text(order)) for order in orders]
+    with orders_cursors_lock:
+        previous = orders_cursors.get(chat_id)
+        page = previous['page'] if previous else 0
+        orders_cursors[chat_id] = {'entries': entries, 'page': page, 'updated_at': time.time()}
+    return page
+
+
+def build_orders_markup(chat_id, page):
+    """Build one page of the order list keyboard from the chat cursor
+
+    Returns None if there is no cursor for the chat or it has expired.
+    """
+    with orders_cursors_lock:
+        cursor = orders_cursors.get(chat_id)
+        if cursor is None or time.time() - cursor['updated_at'] > ORDERS_CURSOR_TTL:
+            orders_cursors.pop(chat_id, None)
+            return None
+
+        entries = cursor['entries']
+        pages_count = max(1, (len(entries) + ORDERS_PAGE_SIZE - 1) // ORDERS_PAGE_SIZE)
+        page = min(max(page, 0), pages_count - 1)
+        cursor['page'] = page
+
+    markup = telebot.types.InlineKeyboardMarkup()
+    for order_id, text in entries[page * ORDERS_PAGE_SIZE:(page + 1) * ORDERS_PAGE_SIZE]:
+        button = telebot.types.InlineKeyboardButton(text=text, callback_data=f'ORDER;{order_id}')
+        markup.add(button)
+
+    if pages_count > 1:
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(telebot.types.InlineKeyboardButton(
+                text='◀️', callback_data=f'ORDERS_PAGE;{page - 1}'
+            ))
+        nav_buttons.append(telebot.types.InlineKeyboardButton(
+            text=f'{page + 1}/{pages_count}', callback_data='ORDERS_PAGE;-'
+        ))
+        if page < pages_count - 1:
+            nav_buttons.append(telebot.types.InlineKeyboardButton(
+                text='▶️', callback_data=f'ORDERS_PAGE;{page + 1}'
+            ))
+        markup.row(*nav_buttons)
+
+    button = telebot.types.InlineKeyboardButton(text='Назад', callback_data='menu')
+    markup.add(button)
+    return markup
+
+
+def prefetch_orders(chat_id, orders):
+    """Warm order cards (text and photos) in the background for the opened order list
+
+    The payloads from the order list are used as is, so only the card text and photos
+    are fetched. Pending prefetch of the previous list of the chat is cancelled, and
+    nothing new is scheduled while too many prefetch tasks are already queued.
+    """
+    with prefetch_lock:
+        for future in prefetch_futures.pop(chat_id, []):
+            future.cancel()
+
+        now = time.time()
+        for order_id in [key for key, entry in prefetch_store.items() if now - entry['fetched_at'] >= PREFETCH_TTL]:
+            del prefetch_store[order_id]
+
+        if is_overloaded():
+            logger.warning(f"Prefetch skipped for chat {chat_id}: bot is overloaded")
+            return
+
+        pending = sum(1 for futures in prefetch_futures.values() for future in futures if not future.done())
+        if pending >= PREFETCH_MAX_PENDING:
+            logger.warning(f"Prefetch skipped for chat {chat_id}: {pending} tasks pending")
+            return
+
+        futures = []
+        for order in orders[:min(PREFETCH_MAX_ORDERS, PREFETCH_MAX_PENDING - pending)]:
+            entry = prefetch_store.get(str(order['id']))
+            if entry is not None:
+                continue
+            futures.append(prefetch_executor.submit(prefetch_order, order))
+        prefetch_futures[chat_id] = futures
+
+
+def prefetch_order(order):
+    try:
+        order_text = f"Заказ: <b>{order['number']}</b>\n"
+        order_text += get_order_text(order)
+        order_photos = get_order_photos(order)
+        with prefetch_lock:
+            prefetch_store[str(order['id'])] = {
+                'order': order,
+                'text': order_text,
+                'photos': order_photos,
+                'fetched_at': time.time(),
+            }
+    except Exception as e:
+        logger.error(f"Error prefetching order {order.get('id')}: {e}")
+
+
+def get_prefetched_order(order_id):
+    """Return a fresh prefetched order card or None"""
+    with prefetch_lock:
+        entry = prefetch_store.get(str(order_id))
+        if entry is None:
+            return None
+        if time.time() - entry['fetched_at'] >= PREFETCH_TTL:
+            del prefetch_store[str(order_id)]
+            return None
+        return entry
+
+
+def drop_prefetched_order(order_id):
+    with prefetch_lock:
+        prefetch_store.pop(str(order_id), None)
 
 
 def get_order_text(order):
@@ -643,10 +1464,7 @@ def get_order_text(order):
 
         # Payment info
         try:
-            payment_types = client.payment_types().get_response()['paymentTypes']
-            payment_type_names = {}
-            for payment_type_code, payment_type in payment_types.items():
-                payment_type_names[payment_type['code']] = payment_type['name']
+            payment_type_names = get_payment_type_names()
 
             payments = order.get('payments', {})
             if payments:
@@ -699,7 +1517,111 @@ def index():
 @app.route('/health')
 def health():
     """Health check endpoint to keep service awake"""
-    return jsonify({'status': 'ok', 'service': 'bot-kurier'})
+    result = {'status': 'ok', 'service': 'bot-kurier', 'startup': startup_metrics}
+    if db is not None:
+        try:
+            result['outbox'] = db.get_outbox_stats()
+            result['load'] = {
+                'queued': update_queue.qsize(),
+                'crm_latency_seconds': round(client.latency, 3),
+                'shed': load_stats['shed'],
+            }
+        except Exception as e:
+            logger.error(f"Error getting outbox stats: {e}")
+    return jsonify(result)
+
+
+def check_export_auth():
+    """Check the dispatcher token from the Authorization header
+
+    The token is not accepted as a query parameter, so it does not end up in access logs.
+    """
+    if not EXPORT_TOKEN:
+        return False
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return False
+    # compare_digest only accepts ASCII strings, bytes work for any token
+    return hmac.compare_digest(auth_header[len('Bearer '):].encode(), EXPORT_TOKEN.encode())
+
+
+def parse_export_range():
+    """Get the export date range from the 'from' and 'to' parameters (YYYY-MM-DD, both inclusive)"""
+    start_date = datetime.strptime(request.args['from'], '%Y-%m-%d')
+    end_date = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1)
+    return start_date, end_date
+
+
+def stream_export(columns, rows, export_format):
+    """Stream rows as CSV or NDJSON in chunks of EXPORT_CHUNK_ROWS"""
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+
+        count = 0
+        for row in rows:
+            if export_format == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                buffer.write('\n')
+
+            count += 1
+            if count % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype)
+
+
+@app.route('/export/completed_orders')
+def export_completed_orders():
+    """Export completed orders for a date range, optionally for one courier"""
+    if not check_export_auth():
+        return 'Forbidden', 403
+    if db is None:
+        return 'Starting up', 503
+
+    try:
+        start_date, end_date = parse_export_range()
+        courier_id = int(request.args['courier_id']) if request.args.get('courier_id') else None
+    except (KeyError, ValueError):
+        return jsonify({'error': "Expected 'from' and 'to' as YYYY-MM-DD and an optional numeric 'courier_id'"}), 400
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': "'format' must be csv or ndjson"}), 400
+
+    rows = db.iter_completed_orders_between(start_date, end_date, courier_id)
+    return stream_export(['courier_id', 'order_id', 'order_number', 'completed_at'], rows, export_format)
+
+
+@app.route('/export/stats')
+def export_stats():
+    """Export the number of completed orders per courier for each day, week or month of a date range"""
+    if not check_export_auth():
+        return 'Forbidden', 403
+    if db is None:
+        return 'Starting up', 503
+
+    try:
+        start_date, end_date = parse_export_range()
+    except (KeyError, ValueError):
+        return jsonify({'error': "Expected 'from' and 'to' as YYYY-MM-DD"}), 400
+
+    period = request.args.get('period', 'day')
+    export_format = request.args.get('format', 'csv')
+    if period not in ('day', 'week', 'month') or export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': "'period' must be day, week or month and 'format' csv or ndjson"}), 400
+
+    rows = db.iter_completed_orders_stats(start_date, end_date, period)
+    return stream_export(['period_start', 'courier_id', 'order_count'], rows, export_format)
 
 
 @app.route('/<path:token>', methods=['POST'])
@@ -711,10 +1633,16 @@ def webhook(token):
         return 'Invalid token', 403
     
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        logger.info(f"Webhook data: {json_string[:200]}...")
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        update = decode_update(request.get_data())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Webhook data: {update}")
+        # The update that woke up the service usually arrives while migrations are running
+        storage_ready.wait(STORAGE_WAIT_TIMEOUT)
+        if not accept_update(update):
+            # Telegram retries the update, it will reach this instance once the database is ready
+            # or the instance taking over
+            return 'Unavailable', 503
+        record_startup_metric('first_update_seconds')
         logger.info("Webhook processed successfully")
         return ''
     else:
@@ -733,35 +1661,29 @@ def main():
         logger.error("Failed to initialize bot. Exiting.")
         sys.exit(1)
     
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
     if WEBHOOK_HOST:
-        logger.info(f"Setting up webhook at {WEBHOOK_URL}")
-        try:
-            # Remove webhook first
-            bot.remove_webhook()
-            time.sleep(2)
-            result = bot.set_webhook(url=WEBHOOK_URL)
-            logger.info(f"Webhook set up result: {result}")
-            
-            # Verify webhook
-            webhook_info = bot.get_webhook_info()
-            logger.info(f"Webhook info: {webhook_info}")
-        except Exception as e:
-            logger.error(f"Webhook setup error: {e}")
-        
-        # Run Flask app
+        # Bind the port first, the database and Telegram calls are set up in the background
         logger.info(f"Starting Flask server on port {WEBHOOK_PORT}")
-        app.run(host='0.0.0.0', port=WEBHOOK_PORT)
+        server = make_server('0.0.0.0', WEBHOOK_PORT, app, threaded=True)
+        record_startup_metric('ready_seconds')
+
+        threading.Thread(target=init_storage_or_exit, name='storage-init', daemon=True).start()
+        threading.Thread(target=setup_webhook, name='webhook-setup', daemon=True).start()
+        server.serve_forever()
     else:
         logger.info("No RENDER_EXTERNAL_HOSTNAME set, using polling mode")
+        if not init_storage():
+            logger.error("Failed to initialize storage. Exiting.")
+            sys.exit(1)
         while True:
             try:
                 logger.info("Starting polling...")
-                bot.polling(
-                    none_stop=True,
-                    interval=1,
-                    timeout=30,
-                    long_polling_timeout=30
-                )
+                record_startup_metric('ready_seconds')
+                poll_updates()
             except Exception as e:
                 logger.error(f"Polling error: {e}")
                 logger.info("Restarting in 5 seconds...")
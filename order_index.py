@@ -0,0 +1,102 @@
+"""In-memory search index over the active orders of one courier
+
+Every word of the order number, delivery address and recipient is indexed by
+all of its prefixes, so a search is a few dict lookups and set intersections.
+"""
+import re
+import threading
+import time
+
+MAX_PREFIX_LENGTH = 20
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def get_order_address(order):
+    address = order.get('delivery', {}).get('address', {})
+    if address.get('text'):
+        return address['text']
+    return ', '.join(str(address[field]) for field in ('city', 'street', 'building', 'flat') if address.get(field))
+
+
+def get_order_search_entry(order):
+    """Get the fields of an order shown in search results"""
+    return {
+        'id': str(order['id']),
+        'number': str(order.get('number', '')),
+        'address': get_order_address(order),
+        'recipient': order.get('customFields', {}).get('poluchatel', '') or '',
+        'delivery_date': order.get('delivery', {}).get('date', ''),
+    }
+
+
+class OrderIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._prefixes = {}
+        self.updated_at = 0
+
+    def _tokens(self, entry):
+        tokens = set(tokenize(entry['number']))
+        # Order numbers like "12345A" are also found by their digits
+        tokens.update(re.findall(r'\d+', entry['number']))
+        tokens.update(tokenize(entry['address']))
+        tokens.update(tokenize(entry['recipient']))
+        return tokens
+
+    def _add(self, entry):
+        self._entries[entry['id']] = entry
+        for token in self._tokens(entry):
+            for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                self._prefixes.setdefault(token[:length], set()).add(entry['id'])
+
+    def _remove(self, order_id):
+        entry = self._entries.pop(order_id, None)
+        if entry is None:
+            return
+        for token in self._tokens(entry):
+            for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                order_ids = self._prefixes.get(token[:length])
+                if order_ids is not None:
+                    order_ids.discard(order_id)
+                    if not order_ids:
+                        del self._prefixes[token[:length]]
+
+    def replace(self, orders):
+        """Sync the index with the current order list, only changed orders are re-indexed"""
+        entries = {entry['id']: entry for entry in map(get_order_search_entry, orders)}
+        with self._lock:
+            for order_id in [order_id for order_id in self._entries if order_id not in entries]:
+                self._remove(order_id)
+            for order_id, entry in entries.items():
+                if self._entries.get(order_id) != entry:
+                    self._remove(order_id)
+                    self._add(entry)
+            self.updated_at = time.time()
+
+    def remove(self, order_id):
+        with self._lock:
+            self._remove(str(order_id))
+
+    def search(self, query, limit=20):
+        """Find orders matching all words of the query by prefix, returns entries sorted by number"""
+        tokens = [token[:MAX_PREFIX_LENGTH] for token in tokenize(query)]
+        with self._lock:
+            if not tokens:
+                order_ids = set(self._entries)
+            else:
+                order_ids = None
+                for token in tokens:
+                    matches = self._prefixes.get(token, set())
+                    order_ids = matches.copy() if order_ids is None else order_ids & matches
+                    if not order_ids:
+                        return []
+            entries = [self._entries[order_id] for order_id in order_ids]
+
+        entries.sort(key=lambda entry: entry['number'])
+        return entries[:limit]
@@ -0,0 +1,182 @@
+"""Storage backends for DB: a local SQLite file or a shared PostgreSQL server"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class Cursor:
+    """Thin cursor wrapper, queries are written with '?' placeholders for every backend"""
+
+    def __init__(self, cursor, backend):
+        self._cursor = cursor
+        self._backend = backend
+
+    def execute(self, query, params=()):
+        self._cursor.execute(self._backend.prepare(query), params)
+
+    def executemany(self, query, params):
+        self._cursor.executemany(self._backend.prepare(query), params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class ServerSideCursor(Cursor):
+    """PostgreSQL cursor that streams results from the server, a new named cursor is opened for each query"""
+
+    def __init__(self, db, backend):
+        super().__init__(None, backend)
+        self._db = db
+        self._count = 0
+
+    def execute(self, query, params=()):
+        if self._cursor is not None:
+            self._cursor.close()
+        self._count += 1
+        self._cursor = self._db.cursor(name=f'stream_{self._count}')
+        self._cursor.execute(self._backend.prepare(query), params)
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+
+
+class SQLiteBackend:
+    dialect = 'sqlite'
+
+    def __init__(self, path='db.sqlite3'):
+        self._path = path
+
+        # WAL lets read-only connections run alongside writes
+        db = sqlite3.connect(self._path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.close()
+
+    @contextmanager
+    def connection(self):
+        """Open a connection and yield a cursor, the transaction is committed on success"""
+        db = sqlite3.connect(self._path)
+        try:
+            yield Cursor(db.cursor(), self)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @contextmanager
+    def read_only_connection(self):
+        """Open a read-only connection for long reads such as exports"""
+        db = sqlite3.connect(f'file:{self._path}?mode=ro', uri=True)
+        try:
+            yield Cursor(db.cursor(), self)
+        finally:
+            db.close()
+
+    @contextmanager
+    def archive_connection(self, name, read_only=False):
+        """Open the archive database `name`, a separate file in the db-archive directory
+
+        Archived rows are kept out of the main file, so it does not grow with every delivery.
+        """
+        directory = f"{os.path.splitext(self._path)[0]}-archive"
+        path = os.path.join(directory, f"{name}.sqlite3")
+        if read_only:
+            db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(path)
+        try:
+            yield Cursor(db.cursor(), self)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def prepare(self, query):
+        return query
+
+    def lock_schema(self, cursor):
+        # SQLite takes the database write lock on the first write of the transaction
+        pass
+
+
+class PostgresBackend:
+    dialect = 'postgres'
+
+    def __init__(self, url, min_connections=1, max_connections=10):
+        try:
+            from psycopg2.pool import ThreadedConnectionPool
+        except ImportError:
+            raise RuntimeError("psycopg2 is required for DATABASE_URL, install psycopg2-binary")
+
+        self._pool = ThreadedConnectionPool(min_connections, max_connections, url)
+        # ThreadedConnectionPool fails instead of waiting when all connections are taken
+        self._available = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self):
+        """Take a connection from the pool and yield a cursor, the transaction is committed on success"""
+        with self._available:
+            db = self._pool.getconn()
+            try:
+                cursor = db.cursor()
+                yield Cursor(cursor, self)
+                db.commit()
+                cursor.close()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                self._pool.putconn(db)
+
+    @contextmanager
+    def read_only_connection(self):
+        """Take a connection in a read-only transaction for long reads such as exports"""
+        with self._available:
+            db = self._pool.getconn()
+            try:
+                db.set_session(readonly=True)
+                cursor = ServerSideCursor(db, self)
+                yield cursor
+                cursor.close()
+            finally:
+                db.rollback()
+                db.set_session(readonly=False)
+                self._pool.putconn(db)
+
+    def archive_connection(self, name, read_only=False):
+        """Archive tables are kept in the same database, there is no file to keep small"""
+        return self.read_only_connection() if read_only else self.connection()
+
+    def prepare(self, query):
+        return query.replace('?', '%s')
+
+    def lock_schema(self, cursor):
+        # Serialize migrations of instances starting at the same time
+        cursor.execute("SELECT pg_advisory_xact_lock(7301)")
+
+
+def get_backend(database_url=None, **kwargs):
+    """Create a backend for the database URL, SQLite file is used if it is not set"""
+    if not database_url:
+        return SQLiteBackend()
+    if database_url.startswith('sqlite:///'):
+        return SQLiteBackend(database_url[len('sqlite:///'):])
+    if database_url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(database_url, **kwargs)
+    raise ValueError(f"Unsupported database URL: {database_url.split(':', 1)[0]}")
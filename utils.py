@@ -1,3 +1,61 @@
+import threading
+
+
 def separate_callback_data(data):
     """ Separate the callback data"""
     return data.split(";")
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one execution
+
+    Callers that arrive while a call with the same key is in flight wait for it
+    and get its result instead of running the function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Run fn once per key at a time, returns (result, shared)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+        return call['result'], False
+
+
+class FreshClient:
+    """Proxy that makes every call on a new client instance
+
+    retailcrm clients keep request arguments in a `parameters` dict that is never
+    reset, so an instance shared between threads (or calls) mixes up their filters.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)